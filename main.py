@@ -9,13 +9,14 @@ import os
 import re
 import time
 import datetime
+from functools import partial
 
 import click
 import pyfiglet
 
 from src._export_utils import to_csv, to_xml
 from src._utils import _report_log, _timing
-from src.WebConvLib import open_web_anno_tsv
+from src.WebConvLib import open_web_anno_tsv, AnnotationRow
 
 
 ASCII_LOGO = pyfiglet.figlet_format("| WebAnnoTSV Converter |")
@@ -25,7 +26,9 @@ date = datetime.datetime.now()
 @click.argument('file',
                 nargs=1)
 @click.argument('output',
-                nargs=1)
+                nargs=1,
+                metavar='OUTPUT',
+                type=click.Choice(['csv', 'xml'], case_sensitive=False))
 @click.option('-od',
               '--output_dir',
               default="./out/",
@@ -63,6 +66,16 @@ date = datetime.datetime.now()
               type=str,
               required=False,
               help='If you use a specific language as fr, en, de, it, es, indicate here.')
+@click.option('-w',
+              '--workers',
+              default=1,
+              show_default=True,
+              type=int,
+              required=False,
+              help='Number of processes used to parse the sentences '
+                   '(1 to parse sequentially). Each process keeps its own '
+                   'Entity-Fishing cache and opens up to 16 connections to the '
+                   'service: a same Wikidata ID can be fetched once per process.')
 
 @_timing
 def main(file: str,
@@ -71,7 +84,8 @@ def main(file: str,
          output_dir: str,
          project_name: str,
          api_base: str,
-         language: str):
+         language: str,
+         workers: int):
     """
     WebAnnoTSV-converter\b\n
     2021\b\n
@@ -86,67 +100,56 @@ def main(file: str,
     print(ASCII_LOGO)
     print(f'{date.strftime("%Y-%m-%d %H:%M:%S")}\n')
     _report_log(f"Start process with file : {file} | type output :  {output} | verbose : {verbose}", type_log="V")
+
+    writers = {
+        "csv": to_csv,
+        "xml": partial(to_xml, project_name=project_name)
+    }
+    writer = writers[output.lower()]
     time.sleep(3)
 
     filename = os.path.basename(file)
     filename = re.sub(r'\.tsv', '', filename)
 
-    data = []
+    def verbose_rows(reader):
+        # Print each sentence (even without annotation) and its annotation rows
+        # while they go to the writer
+        for index_sentence, sentence in enumerate(reader.read(workers=workers)):
+            print(f"Sentence {index_sentence}: ", sentence.text)
+            for index_annot, annotation in enumerate(sentence.annotations):
+                row = AnnotationRow(index_sentence,
+                                    sentence.text,
+                                    index_annot,
+                                    annotation.text,
+                                    annotation.label,
+                                    annotation.truth_start,
+                                    annotation.truth_stop,
+                                    annotation.length,
+                                    annotation.wikiname,
+                                    annotation.wikidata_id,
+                                    annotation.wikipedia_id)
+                print(f'\tAnnotation {row.index_annot}:')
+                print('\t\tText :', row.text)
+                print("\t\tLabel :", row.label)
+                print("\t\tOffset Start : ", f"{row.start}")
+                print("\t\tOffset End : ", f"{row.stop}")
+                print("\t\tTotal length : ", row.length)
+                print("\t\tWikiName : ", row.wikiname)
+                print("\t\tWikidata ID : ", row.wikidata_id)
+                print("\t\tWikipedia page ID : ", row.wikipedia_id)
+                yield row
 
     with open_web_anno_tsv(file, api_base, language) as f:
-        for i, sentence in enumerate(f):
-            sentence_text = sentence.text
-            index_sentence = i
-            if verbose:
-                print(f"Sentence {index_sentence}: ", sentence_text)
-            for j, annotation in enumerate(sentence.annotations):
-                index_annot = j
-                text = annotation.text
-                label = annotation.label
-                # offset_start = annotation.start
-                # offset_end = annotation.stop
-                truth_start = annotation.truth_start
-                truth_stop = annotation.truth_stop
-                length = annotation.length
-                wikiname = annotation.wikiname
-                wikidata_id = annotation.wikidata_id
-                wikipedia_page_id = annotation.wikipedia_id
-                if verbose:
-                    print(f'\tAnnotation {index_annot}:')
-                    print('\t\tText :', text)
-                    print("\t\tLabel :", label)
-                    print("\t\tOffset Start : ", f"{truth_start}")
-                    print("\t\tOffset End : ", f"{truth_stop}")
-                    print("\t\tTotal length : ", length)
-                    print("\t\tWikiName : ", wikiname)
-                    print("\t\tWikidata ID : ", wikidata_id)
-                    print("\t\tWikipedia page ID : ", wikipedia_page_id)
-                data.append((index_sentence,
-                             sentence_text,
-                             index_annot,
-                             text,
-                             label,
-                             truth_start,
-                             truth_stop,
-                             length,
-                             wikiname,
-                             wikidata_id,
-                             wikipedia_page_id))
-
-    if output.lower() == "csv":
-        to_csv(data,
+        # Rows are yielded one by one to the writer, instead of being buffered
+        if verbose:
+            rows = verbose_rows(f)
+        else:
+            rows = f.rows(workers=workers)
+        writer(rows,
                filename,
                out_dirname=output_dir)
-        _report_log(f"Finish with success find your document in out/ directory",
-                        type_log="S")
-    if output.lower() == "xml":
-        to_xml(data,
-                filename,
-                out_dirname=output_dir,
-                project_name=project_name)
-        _report_log(f"Finish with success find your document in out/ directory",
-                        type_log="S")
-
+    _report_log(f"Finish with success find your document in out/ directory",
+                    type_log="S")
 
 if __name__ == '__main__':
     main()
@@ -12,20 +12,37 @@ NOTES :
 # Licence : MIT
 
 from dataclasses import dataclass, field
-from typing import List, Dict, Union, Tuple, Generator, Optional, TextIO
-from itertools import groupby
-import uuid
-import re
-from collections import defaultdict
+from typing import List, Dict, Union, Tuple, Generator, Optional, TextIO, Callable, Iterable, Iterator
+from itertools import count, islice
+from functools import lru_cache, partial
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from collections import defaultdict, namedtuple
 import traceback
+import sys
+import os
+from urllib.parse import urljoin
 
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 from nerd import nerd_client
 
 
+# Spans and annotations are created for each token: no per-instance __dict__
+# when dataclass slots are available (Python 3.10+)
+_DATACLASS_OPTIONS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+# Offsets and compactness checks of the annotations, off by default
+# (set WEBCONV_VALIDATE=1 to enable them)
+_VALIDATE = os.environ.get('WEBCONV_VALIDATE') == '1'
+
+
 class ReadException(Exception):
     pass
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class Annotation:
     label: str
     text: str
@@ -40,7 +57,7 @@ class Annotation:
     id: Optional[str] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class Span:
     text: str
     start: int
@@ -55,40 +72,102 @@ class Span:
     id: Optional[str] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class SpanAnnotation:
     span: Span
-    annotations: Dict[str, str] = field(default_factory={})
+    annotations: Dict[str, str] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class AnnotatedSentence:
     text: str
     tokens: []
     annotations: List[Annotation]
 
 
+# Flat annotation, as written by the CSV / XML exports
+AnnotationRow = namedtuple('AnnotationRow', ['index_sentence',
+                                             'sentence_text',
+                                             'index_annot',
+                                             'text',
+                                             'label',
+                                             'start',
+                                             'stop',
+                                             'length',
+                                             'wikiname',
+                                             'wikidata_id',
+                                             'wikipedia_id'])
+
+
 def escape_text(text: str) -> str:
     """The Inception doc is wrong about what it is really escaped
     """
-    text = text.replace('\\', '\\\\')
-    text = text.replace('\r', '\\r')
-    text = text.replace('\t', '\\t')
-    return text
+    return text.replace('\\', '\\\\').replace('\r', '\\r').replace('\t', '\\t')
 
 
 def un_escape_text(text: str) -> str:
     """The Inception doc is wrong about what it is really escaped
     """
-    text = re.sub(r'(?<=\\)\\r', '\r', text)
-    text = re.sub(r'(?<=\\)\\t', '\t', text)
-    return text
+    # Only `\r` / `\t` preceded by another backslash are replaced,
+    # this preceding backslash is kept
+    return text.replace('\\\\r', '\\\r').replace('\\\\t', '\\\t')
 
-def fetch_wikipedia_prefferedterm_page_id(concept_wikidata: str, api_base: str, language: str) -> str:
-    # Fetch Wikipedia term and Wikipedia page id with Entity-Fishing API
-    client = nerd_client.NerdClient(apiBase=api_base)
+
+def split_label(part: str) -> Tuple[str, Optional[str]]:
+    """Split an annotation part in label and label id (if any)
+    e.g. LOCATION[2] -> ('LOCATION', '2') | LOCATION -> ('LOCATION', None)
+    """
+    if part.endswith(']'):
+        start = part.rfind('[')
+        label_id = part[start + 1:-1]
+        if start != -1 and (not label_id or label_id.isdigit()):
+            return part[:start], label_id or None
+    return part, None
+
+class _SessionNerdClient(nerd_client.NerdClient):
+    """Entity-Fishing client sending its requests through a single keep-alive
+    HTTP session (the base client opens a new connection for each request)
+    """
+    def __init__(self, apiBase: str):
+        super().__init__(apiBase=apiBase)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def call_api(self, method, url, headers=None, params=None, data=None, files=None, timeout=None):
+        # Same as ApiClient.call_api, with the session
+        headers = dict(headers or {})
+        headers['Accept'] = self.accept_type
+        params = dict(params or {})
+        if self.username and self.api_key:
+            params.update(self.get_credentials())
+
+        r = self.session.request(method.upper(),
+                                 urljoin(self.base_url, url),
+                                 headers=headers,
+                                 params=params,
+                                 files=files or {},
+                                 data=data or {},
+                                 timeout=timeout)
+        return r, r.status_code
+
+
+@lru_cache(maxsize=None)
+def _nerd_client(api_base: str) -> nerd_client.NerdClient:
+    # One Entity-Fishing client per service, reused for every lookup
+    client = _SessionNerdClient(apiBase=api_base)
     client.api_base = api_base
-    content, response = client.get_concept(concept_wikidata, lang=language)
+    return client
+
+
+# Concepts already fetched, on (Wikidata ID, service, language): the same concept
+# is usually annotated many times in a document
+_CONCEPTS: Dict[Tuple[str, str, str], Tuple[int, str]] = {}
+
+
+def _fetch_concept(concept_wikidata: str, api_base: str, language: str) -> Tuple[int, str]:
+    content, response = _nerd_client(api_base).get_concept(concept_wikidata, lang=language)
     try:
         if language == "en":
             wikiname = content['preferredTerm']
@@ -106,35 +185,78 @@ def fetch_wikipedia_prefferedterm_page_id(concept_wikidata: str, api_base: str,
     return wikipedia_page, wikiname
 
 
+def fetch_wikipedia_prefferedterm_page_id(concept_wikidata: str, api_base: str, language: str) -> Tuple[int, str]:
+    # Fetch Wikipedia term and Wikipedia page id with Entity-Fishing API
+    if concept_wikidata == "null":
+        return -1, "null"
+    key = (concept_wikidata, api_base, language)
+    if key not in _CONCEPTS:
+        _CONCEPTS[key] = _fetch_concept(concept_wikidata, api_base, language)
+    return _CONCEPTS[key]
+
+
+def resolve_concepts(concepts_wikidata: Iterable[str],
+                     api_base: str,
+                     language: str,
+                     max_workers: int = 16) -> Dict[str, Tuple[int, str]]:
+    # Fetch a batch of distinct Wikidata IDs concurrently,
+    # returns {Wikidata ID: (Wikipedia page id, Wikipedia term)}
+    concepts = {}
+    missing = []
+    for concept_wikidata in set(concepts_wikidata):
+        key = (concept_wikidata, api_base, language)
+        if concept_wikidata == "null" or key in _CONCEPTS:
+            concepts[concept_wikidata] = fetch_wikipedia_prefferedterm_page_id(concept_wikidata, api_base, language)
+        else:
+            missing.append(concept_wikidata)
+
+    # Only the concepts not fetched yet go to the service
+    fetch = partial(fetch_wikipedia_prefferedterm_page_id, api_base=api_base, language=language)
+    if len(missing) == 1:
+        concepts[missing[0]] = fetch(missing[0])
+    elif missing:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            concepts.update(zip(missing, executor.map(fetch, missing)))
+    return concepts
+
+
 
 class IndexMapper:
     """To deal with special Inception string offsets. Cf Appendix B: WebAnno TSV 3.2 File format
     """
     def __init__(self, text):
-        self.map: List[Tuple[int, int]] = []
-        self.inverse: List[Tuple[int, int]] = []
-
-        for i, char in enumerate(text):
-            char_java_length = len(char.encode('utf-16-le')) // 2  # le (little indian) to avoid BOM mark
-            if i == 0:
-                start = 0
-            else:
-                start = self.map[-1][1]
-            stop = start + char_java_length
-            self.map.append((start, stop))
-
-            for _ in range(char_java_length):
-                self.inverse.append((i, i+ 1))
+        # UTF-16 code units of the text, le (little indian) to avoid BOM mark
+        units = np.frombuffer(text.encode('utf-16-le'), dtype=np.uint16)
+        # A character outside the BMP is encoded as a high + low surrogate pair,
+        # one entry per character: 2 code units for a high surrogate, else 1
+        surrogates = units & 0xFC00
+        char_java_lengths = np.where(surrogates[surrogates != 0xDC00] == 0xD800, 2, 1)
+
+        # map: character index -> (start, stop) in code units
+        stops = np.cumsum(char_java_lengths)
+        self.map: np.ndarray = np.stack((stops - char_java_lengths, stops), axis=1)
+        # inverse: code unit index -> character index
+        self.inverse: np.ndarray = np.repeat(np.arange(len(char_java_lengths)), char_java_lengths)
 
     @staticmethod
     def utf16_blocks(text: str):
         return len(text.encode('utf-16-le')) // 2
 
     def true_offsets(self, start: int, stop: int) -> Tuple[int, int]:
-        return self.inverse[start][0], self.inverse[stop - 1][1]
+        return int(self.inverse[start]), int(self.inverse[stop - 1]) + 1
+
+    def java_offsets(self, start: int, stop: int) -> Tuple[int, int]:
+        return int(self.map[start, 0]), int(self.map[stop - 1, 1])
+
+
+class _IdentityMapper:
+    """For ASCII text, where Python offsets and Java (UTF-16) offsets are the same
+    """
+    def true_offsets(self, start: int, stop: int) -> Tuple[int, int]:
+        return start, stop
 
     def java_offsets(self, start: int, stop: int) -> Tuple[int, int]:
-        return self.map[start][0], self.map[stop - 1][1]
+        return start, stop
 
 
 class Reader:
@@ -143,6 +265,7 @@ class Reader:
 
         self.api_base = api_base
         self.language = language
+        self.resolver = partial(resolve_concepts, api_base=api_base, language=language)
 
 
         self.header: str = ''
@@ -158,107 +281,184 @@ class Reader:
 
         self.f: Optional[TextIO] = None
 
-    def read(self) -> Generator[AnnotatedSentence, None, None]:
+    def read(self, workers: int = 1, chunksize: int = 32) -> Generator[AnnotatedSentence, None, None]:
+        yield from self._map_blocks(Reader.get_annotated_sentence_args, workers, chunksize)
+
+    def rows(self, workers: int = 1, chunksize: int = 32) -> Generator[AnnotationRow, None, None]:
+        """Yields the annotations of the file as flat rows,
+        without building the annotated sentences
+        """
+        for rows in self._map_blocks(Reader.get_annotation_rows_args, workers, chunksize):
+            yield from rows
+
+    def _map_blocks(self, function: Callable, workers: int, chunksize: int) -> Generator:
+        blocks = ((lines, sentence_index, self.resolver) for sentence_index, lines in self.blocks())
+        if workers > 1:
+            # Sentences are independent: parse them in worker processes,
+            # imap keeps the original order of the sentences.
+            # Each worker has its own concept cache and HTTP connections
+            with Pool(processes=workers) as pool:
+                yield from pool.imap(function, blocks, chunksize=chunksize)
+        else:
+            yield from map(function, blocks)
+
+    def blocks(self) -> Generator[Tuple[int, List[str]], None, None]:
+        """Yields the raw lines of each sentence block with the sentence index
+        """
         if not self.f:
             self.open()
 
         sentence_index: int = 0
         lines: List[str] = []
-        n: int = 0
-
-        while True:
-            line = self.f.readline()
-            n += 1
-            if n > self.header_size + 2:
-                if line == '\n' or line == "":
-                    # A sentence block has stop
-                    annotated_sentence = Reader.get_annotated_sentence(lines, sentence_index, self.api_base, self.language)
-                    yield annotated_sentence
-                    lines = []
-                    sentence_index += 1
-                else:
-                    # Remove \n at the stop of the line.
-                    # We don't use strip() to preserve other whitespaces if any
-                    lines.append(line[0:-1])
 
-            # End of file
-            if line == '':
-                break
+        # Skip the header and the two empty lines after it
+        for line in islice(self.f, self.header_size + 2, None):
+            if line == '\n':
+                # A sentence block has stop
+                yield sentence_index, lines
+                lines = []
+                sentence_index += 1
+            else:
+                # Remove \n at the stop of the line.
+                # We don't use strip() to preserve other whitespaces if any
+                lines.append(line.rstrip('\n'))
+
+        # End of file
+        if lines:
+            yield sentence_index, lines
 
         self.close()
 
     @staticmethod
-    def sentence_part(line) -> Optional[str]:
-        """
-        :param line: sentence
-        :return:    "text" -> for text block
-                    token_index -> for tokens and associated sub-tokens (token and sub-tokens are grouped)
-        """
-        if line.startswith('#Text='):
-            return 'text'
-        elif line == '':
-            return None
-        else:
-            return re.sub(r"\.[0-9]+", '', line[line.index('-') + 1: line.index('\t')])
+    def get_annotated_sentence_args(args: Tuple[List[str], int, Callable]) -> AnnotatedSentence:
+        # Single argument entry point for Pool.imap
+        return Reader.get_annotated_sentence(*args)
+
+    @staticmethod
+    def get_annotation_rows_args(args: Tuple[List[str], int, Callable]) -> List[AnnotationRow]:
+        # Single argument entry point for Pool.imap
+        return Reader.get_annotation_rows(*args)
+
+    @staticmethod
+    def get_annotated_sentence(lines: List[str],
+                               sentence_index: int,
+                               resolver: Callable[[Iterable[str]], Dict[str, Tuple[int, str]]]) -> AnnotatedSentence:
+        sentence, spans, compacted_annotations = Reader.read_sentence(lines, sentence_index, resolver)
+
+        annotations = [Annotation(
+            label=label,
+            text=sentence[start: stop],
+            wikiname=wiki_name,
+            wikidata_id=wikidata,
+            wikipedia_id=wikipedia,
+            length=stop - start,
+            start=start,
+            stop=stop,
+            truth_start=truth_start,
+            truth_stop=truth_stop
+        ) for start, stop, label, wiki_name, wikidata, wikipedia, truth_start, truth_stop in compacted_annotations]
+
+        # Extract tokens
+        tokens = [span for span in spans if span.is_token]
+
+        return AnnotatedSentence(sentence, tokens, annotations)
 
     @staticmethod
-    def get_annotated_sentence(lines: List[str], sentence_index: int, api_base: str, language: str) -> AnnotatedSentence:
+    def get_annotation_rows(lines: List[str],
+                            sentence_index: int,
+                            resolver: Callable[[Iterable[str]], Dict[str, Tuple[int, str]]]) -> List[AnnotationRow]:
+        sentence, _, compacted_annotations = Reader.read_sentence(lines, sentence_index, resolver)
+
+        return [AnnotationRow(sentence_index,
+                              sentence,
+                              index_annot,
+                              sentence[start: stop],
+                              label,
+                              truth_start,
+                              truth_stop,
+                              stop - start,
+                              wiki_name,
+                              wikidata,
+                              wikipedia)
+                for index_annot, (start, stop, label, wiki_name, wikidata, wikipedia, truth_start, truth_stop)
+                in enumerate(compacted_annotations)]
+
+    @staticmethod
+    def read_sentence(lines: List[str],
+                      sentence_index: int,
+                      resolver: Callable[[Iterable[str]], Dict[str, Tuple[int, str]]]) -> Tuple[str, List[Span], List[tuple]]:
+        """
+        :return:    sentence text,
+                    spans,
+                    sorted annotations as tuples
+                    (start, stop, label, wikiname, wikidata_id, wikipedia_id, truth_start, truth_stop)
+        """
         sentence = ''
+        text_parts: List[str] = []
+        # Ids for the annotations without [id], unique within the sentence
+        anonymous_ids = count()
         try:
             spans: Union[List[Span], Span] = []
             annotations = defaultdict(list)
             labels = {}
-            for group_index, (group_id, group) in enumerate(groupby(lines, key=lambda l: Reader.sentence_part(l))):
-                group = list(group)
-                if group_id == 'text':
+            for line in lines:
+                if line.startswith('#Text='):
                     # Extract sentence
-                    sentence = "\n".join([un_escape_text(line[6:]) for line in group])
+                    text_parts.append(un_escape_text(line[6:]))
 
-                else:
+                elif '\t' in line:
                     # Extract annotations
-                    for j, line in enumerate(group):
-                        if line != '':
-                            # # Read the token line
-                            span_annotation = Reader.read_token_line(line, api_base, language)
-                            span = span_annotation.span
-
-                            # Register span
-                            spans.append(span)
-
-                            # Annotations
-                            for label_id, label in span_annotation.annotations.items():
-                                if annotations[label_id] and span.start == annotations[label_id][-1].start:
-                                    # In Inception, for some strange reasons,
-                                    # The entire token inherits label from the the first sub-word,
-                                    # if this sub-word is at the beginning of the token.
-                                    # We remove it.
-                                    annotations[label_id] = annotations[label_id][:-1]
-                                labels[label_id] = label
-                                annotations[label_id].append(span)
+                    # # Read the token line
+                    span_annotation = Reader.read_token_line(line, anonymous_ids)
+                    span = span_annotation.span
+
+                    # Register span
+                    spans.append(span)
+
+                    # Annotations
+                    for label_id, label in span_annotation.annotations.items():
+                        if annotations[label_id] and span.start == annotations[label_id][-1].start:
+                            # In Inception, for some strange reasons,
+                            # The entire token inherits label from the the first sub-word,
+                            # if this sub-word is at the beginning of the token.
+                            # We remove it.
+                            annotations[label_id].pop()
+                        labels[label_id] = label
+                        annotations[label_id].append(span)
+            sentence = "\n".join(text_parts)
+
+            # Resolve all the Wikidata IDs of the sentence in one batch
+            concepts = resolver(span.wikidata_id for span in spans if span.wikiname is None)
+            for span in spans:
+                if span.wikiname is None:
+                    span.wikipedia_id, span.wikiname = concepts[span.wikidata_id]
+                    if span.wikiname == "null":
+                        span.wikidata_id = "null"
 
             # 3 things:
             # - Offsets correction [Cf Appstopix B: WebAnno TSV 3.2 File format]
             # - Make offsets relative to sentence
             # - Validation of the offsets calculation
-            mapper: IndexMapper = IndexMapper(sentence)
+            mapper: Union[IndexMapper, _IdentityMapper] = _IdentityMapper() if sentence.isascii() else IndexMapper(sentence)
             first_span_start: Optional[int] = None
             for i, span in enumerate(spans):
                 if i == 0:
                     first_span_start = span.start
                 span.start, span.stop = mapper.true_offsets(span.start - first_span_start, span.stop - first_span_start)
 
-                error = f"Bad offsets ({span.start}, {span.stop}) for span `{span.text}`"
-                assert sentence[span.start: span.stop] == span.text, error
+                if _VALIDATE and sentence[span.start: span.stop] != span.text:
+                    raise ReadException(f"Bad offsets ({span.start}, {span.stop}) for span `{span.text}`")
 
             # Compact annotation
             compacted_annotations = []
             for annotation_id, annotation_parts in annotations.items():
                 if len(annotation_parts) > 1:
-                    # Check that annotations are compact
-                    for p1, p2 in zip(annotation_parts, annotation_parts[1:]):
-                        space = sentence[p1.stop: p2.start]
-                        error = f"Annotation is not compact between {p1} and {p2}"
-                        assert sentence[p1.stop: p2.start].isspace() or not space, error
+                    if _VALIDATE:
+                        # Check that annotations are compact
+                        for p1, p2 in zip(annotation_parts, annotation_parts[1:]):
+                            space = sentence[p1.stop: p2.start]
+                            if space and not space.isspace():
+                                raise ReadException(f"Annotation is not compact between {p1} and {p2}")
 
                     # Compacts
                     start = annotation_parts[0].start
@@ -277,34 +477,34 @@ class Reader:
                     truth_start = annotation_parts[0].truth_start
                     truth_stop = annotation_parts[0].truth_stop
 
-                compacted_annotations.append(Annotation(
-                    label=labels[annotation_id],
-                    text=sentence[start: stop],
-                    wikiname=wiki_name,
-                    wikidata_id=wikidata,
-                    wikipedia_id=wikipedia,
-                    length=stop - start,
-                    start=start,
-                    stop=stop,
-                    truth_start=truth_start,
-                    truth_stop=truth_stop
-                ))
-
-            # Extract tokens
-            tokens = [span for span in spans if span.is_token]
-
-            # Sort annotations
-            compacted_annotations.sort(key=lambda a: (a.start, -a.stop, a.label))
-
-            return AnnotatedSentence(sentence, tokens, compacted_annotations)
+                compacted_annotations.append((start,
+                                              stop,
+                                              labels[annotation_id],
+                                              wiki_name,
+                                              wikidata,
+                                              wikipedia,
+                                              truth_start,
+                                              truth_stop))
+
+            # Sort annotations by (start, -stop, label): stable sorts from the
+            # last key to the first one
+            compacted_annotations.sort(key=itemgetter(2))
+            compacted_annotations.sort(key=itemgetter(1), reverse=True)
+            compacted_annotations.sort(key=itemgetter(0))
+
+            return sentence, spans, compacted_annotations
         except Exception as e:
             tb = traceback.format_exc()
             tb_str = str(tb)
+            sentence = sentence or "\n".join(text_parts)
             message = f'Sentence {sentence_index}: `{sentence}` ' + tb_str
             raise ReadException(message)
 
     @staticmethod
-    def read_token_line(line, api_base: str, language: str):
+    def read_token_line(line, anonymous_ids: Optional[Iterator[int]] = None):
+        if anonymous_ids is None:
+            anonymous_ids = count()
+
         columns = line.split('\t')
 
         # Id
@@ -320,11 +520,10 @@ class Reader:
         annotations = {}
         if columns[4] != '_':
             for part in columns[4].split('|'):
-                res = re.search(r'([^[]*)(\[(\d*)\])*$', part)
-                label = res.group(1)
-                label_id = res.group(3)
+                label, label_id = split_label(part)
                 if not label_id:
-                    label_id = str(uuid.uuid4())
+                    # Cannot collide with the numeric ids of Inception
+                    label_id = f'_{next(anonymous_ids)}'
                 annotations[label_id] = label
 
         # Wikidata ID, Wikipedia page ID and Wikiname
@@ -334,10 +533,15 @@ class Reader:
             wikipedia_page_id = -1
             wiki_name = "null"
         else:
-            wikidata_id = re.sub(r'http.+/(Q\d+)\[?.*\]?', r'\1', span_wikidata_id)
-            wikipedia_page_id, wiki_name = fetch_wikipedia_prefferedterm_page_id(str(wikidata_id), api_base, language)
-            if wiki_name == "null":
-                wikidata_id = "null"
+            # Wikipedia page ID and Wikiname are resolved afterwards, by batch
+            # e.g. http://www.wikidata.org/entity/Q702409[37] -> Q702409
+            wikidata_id = span_wikidata_id
+            if span_wikidata_id.startswith('http'):
+                qid = span_wikidata_id.rsplit('/', 1)[-1].split('[', 1)[0]
+                if qid.startswith('Q'):
+                    wikidata_id = qid
+            wikipedia_page_id = None
+            wiki_name = None
 
         return SpanAnnotation(
             span=Span(
@@ -6,61 +6,60 @@
 # Licence : MIT
 
 import csv
+from itertools import chain
 import lxml.etree as ET
+from lxml.builder import E
 
 
 def to_csv(data, file_name, out_dirname):
-    file = open(out_dirname + file_name + ".csv", "w")
-    writer = csv.writer(file)
-    writer.writerow(('Index_sentence',
-                     'Sentence',
-                     'Index_annotation',
-                     'Entity',
-                     'Label',
-                     'Offset_Start',
-                     'Offset_End',
-                     'Length',
-                     'Wikipedia_name',
-                     'Wikidata_ID',
-                     'Wikipedia_page_ID'
-                     ))
+    with open(out_dirname + file_name + ".csv", "w", newline='', buffering=1 << 20) as file:
+        writer = csv.writer(file)
+        writer.writerow(('Index_sentence',
+                         'Sentence',
+                         'Index_annotation',
+                         'Entity',
+                         'Label',
+                         'Offset_Start',
+                         'Offset_End',
+                         'Length',
+                         'Wikipedia_name',
+                         'Wikidata_ID',
+                         'Wikipedia_page_ID'
+                         ))
+        writer.writerows(data)
 
-    for line in data:
-        writer.writerow(line)
 
-    file.close()
+def _annotation_element(line):
+    """Returns the <annotation> element of an annotation row
+    """
+    return E.annotation(
+        E.mention(str(line[3])),
+        E.wikiName(str(line[8])),
+        E.wikidataId(str(line[9])),
+        E.wikipediaId(str(line[10])),
+        E.offset(str(line[5])),
+        E.length(str(line[7]))
+    )
 
 
 def to_xml(data, file_name, out_dirname, project_name="my_project"):
-    root = ET.Element(f'{project_name}.entityAnnotation')
-    document = ET.SubElement(root, 'document')
-    document.set('docName', f'{file_name}.txt')
-
-    for line in data:
-        mention_name = line[3]
-        wikiname = line[8]
-        wikidataid = line[9]
-        wikipediaid = line[10]
-        offset_start = line[5]
-        length = line[7]
-
-        annotation_tag = ET.SubElement(document, 'annotation')
-
-        mention = ET.SubElement(annotation_tag, 'mention')
-        mention.text = str(mention_name)
-        wiki_name = ET.SubElement(annotation_tag, 'wikiName')
-        wiki_name.text = str(wikiname)
-        wikidata_id = ET.SubElement(annotation_tag, 'wikidataId')
-        wikidata_id.text = str(wikidataid)
-        wikipedia_id = ET.SubElement(annotation_tag, 'wikipediaId')
-        wikipedia_id.text = str(wikipediaid)
-        offset = ET.SubElement(annotation_tag, 'offset')
-        offset.text = str(offset_start)
-        l = ET.SubElement(annotation_tag, 'length')
-        l.text = str(length)
-
-    b_xml = ET.tostring(root, pretty_print=True, encoding='utf-8')
-
+    # The document is written incrementally, annotation by annotation,
+    # with the same indentation as a pretty printed tree
     with open(out_dirname + project_name + ".xml", "wb") as f:
-        f.write(b_xml)
-
+        with ET.xmlfile(f, encoding='utf-8') as xf:
+            with xf.element(f'{project_name}.entityAnnotation'):
+                xf.write('\n  ')
+                data = iter(data)
+                first_line = next(data, None)
+                if first_line is None:
+                    # No annotation: <document docName="..."/>
+                    xf.write(ET.Element('document', docName=f'{file_name}.txt'))
+                else:
+                    with xf.element('document', docName=f'{file_name}.txt'):
+                        for line in chain((first_line,), data):
+                            annotation_tag = _annotation_element(line)
+                            ET.indent(annotation_tag, level=2)
+                            xf.write('\n    ', annotation_tag)
+                        xf.write('\n  ')
+                xf.write('\n')
+        f.write(b'\n')